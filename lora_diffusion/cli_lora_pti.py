@@ -25,7 +25,7 @@ from diffusers import (
 from diffusers.optimization import get_scheduler
 from huggingface_hub import HfFolder, Repository, whoami
 from PIL import Image
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 from torchvision import transforms
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
@@ -34,6 +34,7 @@ import fire
 
 from lora_diffusion import (
     PivotalTuningDatasetCapation,
+    batch_random_hflip,
     extract_lora_ups_down,
     inject_trainable_lora,
     inject_trainable_lora_extended,
@@ -128,6 +129,18 @@ def get_models(
     )
 
 
+def _pin_batch(batch):
+    # Pin the stacked batch once so the step can copy it with non_blocking=True.
+    # Only safe in the main process; with num_workers > 0 use DataLoader(pin_memory=True).
+    if not torch.cuda.is_available() or get_worker_info() is not None:
+        return batch
+
+    return {
+        k: v.pin_memory() if isinstance(v, torch.Tensor) and not v.is_cuda else v
+        for k, v in batch.items()
+    }
+
+
 @torch.no_grad()
 def text2img_dataloader(
     train_dataset,
@@ -171,7 +184,7 @@ def text2img_dataloader(
         if examples[0].get("mask", None) is not None:
             batch["mask"] = torch.stack([example["mask"] for example in examples])
 
-        return batch
+        return _pin_batch(batch)
 
     if cached_latents:
 
@@ -245,7 +258,18 @@ def inpainting_dataloader(
         if examples[0].get("mask", None) is not None:
             batch["mask"] = torch.stack([example["mask"] for example in examples])
 
-        return batch
+        # flip images and their masks together, once per batch
+        if train_dataset.batch_h_flip:
+            flip_keys = [
+                k
+                for k in ("pixel_values", "mask_values", "masked_image_values", "mask")
+                if k in batch
+            ]
+            flipped = batch_random_hflip([batch[k] for k in flip_keys])
+            for k, v in zip(flip_keys, flipped):
+                batch[k] = v
+
+        return _pin_batch(batch)
 
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
@@ -272,17 +296,21 @@ def loss_step(
     weight_dtype = torch.float32
     if not cached_latents:
         latents = vae.encode(
-            batch["pixel_values"].to(dtype=weight_dtype).to(unet.device)
+            batch["pixel_values"].to(unet.device, dtype=weight_dtype, non_blocking=True)
         ).latent_dist.sample()
         latents = latents * 0.18215
 
         if train_inpainting:
             masked_image_latents = vae.encode(
-                batch["masked_image_values"].to(dtype=weight_dtype).to(unet.device)
+                batch["masked_image_values"].to(
+                    unet.device, dtype=weight_dtype, non_blocking=True
+                )
             ).latent_dist.sample()
             masked_image_latents = masked_image_latents * 0.18215
             mask = F.interpolate(
-                batch["mask_values"].to(dtype=weight_dtype).to(unet.device),
+                batch["mask_values"].to(
+                    unet.device, dtype=weight_dtype, non_blocking=True
+                ),
                 scale_factor=1 / 8,
             )
     else:
@@ -316,7 +344,7 @@ def loss_step(
         with torch.cuda.amp.autocast():
 
             encoder_hidden_states = text_encoder(
-                batch["input_ids"].to(text_encoder.device)
+                batch["input_ids"].to(text_encoder.device, non_blocking=True)
             )[0]
 
             model_pred = unet(
@@ -325,7 +353,7 @@ def loss_step(
     else:
 
         encoder_hidden_states = text_encoder(
-            batch["input_ids"].to(text_encoder.device)
+            batch["input_ids"].to(text_encoder.device, non_blocking=True)
         )[0]
 
         model_pred = unet(latent_model_input, timesteps, encoder_hidden_states).sample
@@ -341,7 +369,7 @@ def loss_step(
 
         mask = (
             batch["mask"]
-            .to(model_pred.device)
+            .to(model_pred.device, non_blocking=True)
             .reshape(
                 model_pred.shape[0], 1, model_pred.shape[2] * 8, model_pred.shape[3] * 8
             )
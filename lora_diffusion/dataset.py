@@ -1,16 +1,19 @@
+import functools
+import os
 import random
+import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Union
 
 from PIL import Image
-from torch import zeros_like
 from torch.utils.data import Dataset
 from torchvision import transforms
-import glob
+from torchvision.io import ImageReadMode, decode_jpeg, read_file, read_image
 from .preprocess_files import face_mask_google_mediapipe
 
 from transformers import CLIPSegProcessor, CLIPSegForImageSegmentation
-from torchvision.transforms.functional import pil_to_tensor
+import torchvision.transforms.functional as TF
 from typing import List, Literal, Union, Optional, Tuple
 import numpy as np
 import torch
@@ -99,33 +102,80 @@ def _get_cutout_holes(
     min_width=16,
     max_width=128,
 ):
-    holes = []
-    for _n in range(random.randint(min_holes, max_holes)):
-        hole_height = random.randint(min_height, max_height)
-        hole_width = random.randint(min_width, max_width)
-        y1 = random.randint(0, height - hole_height)
-        x1 = random.randint(0, width - hole_width)
-        y2 = y1 + hole_height
-        x2 = x1 + hole_width
-        holes.append((x1, y1, x2, y2))
-    return holes
+    n = np.random.randint(min_holes, max_holes + 1)
+    hole_height = np.random.randint(min_height, max_height + 1, size=n)
+    hole_width = np.random.randint(min_width, max_width + 1, size=n)
+    y1 = np.random.randint(0, height - hole_height + 1)
+    x1 = np.random.randint(0, width - hole_width + 1)
+    y2 = y1 + hole_height
+    x2 = x1 + hole_width
+    return x1, y1, x2, y2
 
 
 def _generate_random_mask(image):
-    mask = zeros_like(image[:1])
-    holes = _get_cutout_holes(mask.shape[1], mask.shape[2])
-    for (x1, y1, x2, y2) in holes:
-        mask[:, y1:y2, x1:x2] = 1.0
+    height, width = image.shape[1], image.shape[2]
+    x1, y1, x2, y2 = _get_cutout_holes(height, width)
+
+    # (H, n) row coverage @ (n, W) column coverage counts the holes covering each pixel
+    rows = np.arange(height)
+    cols = np.arange(width)
+    row_in = ((rows[:, None] >= y1) & (rows[:, None] < y2)).astype(np.float32)
+    col_in = ((cols[None, :] >= x1[:, None]) & (cols[None, :] < x2[:, None])).astype(
+        np.float32
+    )
+    mask_np = (row_in @ col_in) > 0
+
     if random.uniform(0, 1) < 0.25:
-        mask.fill_(1.0)
-    masked_image = image * (mask < 0.5)
+        mask_np.fill(True)
+
+    hole = torch.from_numpy(mask_np).unsqueeze(0)
+    mask = hole.to(image.dtype)
+    masked_image = image.masked_fill(hole, 0.0)
     return mask, masked_image
 
 
+@functools.lru_cache(maxsize=2)
+def _load_clipseg(model_id: str, device: torch.device):
+    """
+    Loads the CLIPSeg processor and model once per (model_id, device) and reuses them across calls.
+    """
+    processor = CLIPSegProcessor.from_pretrained(model_id)
+    model = CLIPSegForImageSegmentation.from_pretrained(model_id).to(device).eval()
+
+    return processor, model
+
+
+def _clipseg_pixel_values(images: torch.Tensor, processor) -> torch.Tensor:
+    """
+    Resizes and normalizes a batch of [-1, 1] BCHW images for CLIPSeg on their current device, without going through PIL.
+    """
+    image_processor = getattr(processor, "image_processor", None)
+    if image_processor is None:
+        image_processor = processor.feature_extractor
+
+    size = image_processor.size
+    if isinstance(size, dict):
+        size = (size["height"], size["width"])
+    elif isinstance(size, int):
+        size = (size, size)
+
+    mean = torch.tensor(image_processor.image_mean, device=images.device)
+    std = torch.tensor(image_processor.image_std, device=images.device)
+
+    pixel_values = torch.nn.functional.interpolate(
+        (images.float() + 1.0) / 2.0,
+        size=size,
+        mode="bilinear",
+        align_corners=False,
+        antialias=True,
+    )
+    return (pixel_values - mean[:, None, None]) / std[:, None, None]
+
+
 @torch.no_grad()
-def _generate_clipseg_mask(
-    image,
-    target_prompts,
+def _generate_clipseg_masks(
+    images,
+    target_prompt,
     model_id: Literal[
         "CIDAS/clipseg-rd64-refined", "CIDAS/clipseg-rd16"
     ] = "CIDAS/clipseg-rd64-refined",
@@ -133,46 +183,63 @@ def _generate_clipseg_mask(
     bias: float = 0.01,
     temp: float = 1.0,
     **kwargs,
-) -> List[Image.Image]:
+) -> torch.Tensor:
     """
-    Returns a greyscale mask for each image, where the mask is the probability of the target prompt being present in the image
+    Returns a binary (B, 1, H, W) mask of where the target prompt is present in each image of the batch
     """
 
-    processor = CLIPSegProcessor.from_pretrained(model_id)
-    model = CLIPSegForImageSegmentation.from_pretrained(model_id).to(device)
-
-    masks = []
+    device = torch.device(device)
+    processor, model = _load_clipseg(model_id, device)
 
-    image = (image.numpy() * 255).astype(np.uint8)
-    image_arr = np.moveaxis(image, [0,1,2], [2,0,1])
-    image = Image.fromarray(image_arr)
-    original_size = image.size
+    images = images.to(device)
+    batch_size = images.shape[0]
+    original_size = images.shape[2:]
 
-    inputs = processor(
-        text=[target_prompts, ""],
-        images=[image] * 2,
+    # every image is scored against the prompt and against the empty prompt in a single forward pass
+    text_inputs = processor.tokenizer(
+        [target_prompt] * batch_size + [""] * batch_size,
         padding="max_length",
         truncation=True,
         return_tensors="pt",
     ).to(device)
+    pixel_values = _clipseg_pixel_values(images, processor).repeat(2, 1, 1, 1)
 
-    outputs = model(**inputs)
+    with torch.inference_mode(), torch.autocast(
+        device_type=device.type, dtype=torch.float16, enabled=device.type == "cuda"
+    ):
+        outputs = model(
+            input_ids=text_inputs.input_ids,
+            attention_mask=text_inputs.attention_mask,
+            pixel_values=pixel_values,
+        )
 
-    logits = outputs.logits
+    logits = outputs.logits.float().view(2, batch_size, *outputs.logits.shape[-2:])
     probs = torch.nn.functional.softmax(logits / temp, dim=0)[0]
     probs = (probs + bias).clamp_(0, 1)
-    probs = 255 * probs / probs.max()
+    probs = probs / probs.amax(dim=(1, 2), keepdim=True)
+
+    # resize masks to original size
+    masks = torch.nn.functional.interpolate(
+        probs[:, None], size=original_size, mode="bilinear", align_corners=False
+    )
+
+    return (masks > 0.95).cpu()
 
-    # make mask greyscale
-    mask = Image.fromarray(probs.cpu().numpy()).convert("L")
 
-    # resize mask to original size
-    mask = mask.resize(original_size)
+def batch_random_hflip(tensors: List[torch.Tensor], p: float = 0.5):
+    """
+    Horizontally flips the same random subset of samples in each (B, C, H, W) tensor, on the tensors' device.
+    """
+    flip = torch.rand(tensors[0].shape[0], device=tensors[0].device) < p
+    flip = flip.view(-1, 1, 1, 1)
 
-    mask = (np.expand_dims(np.array(mask) /255, axis=2) > 0.95)
-    masked_image_clip = image_arr * (1- mask)
+    return [torch.where(flip, t.flip(-1), t) for t in tensors]
+
+
+def _open_and_mask(paths: List[str]) -> List[Image.Image]:
+    # Runs in a worker process, so the MediaPipe detector is built once per chunk of paths.
+    return face_mask_google_mediapipe([Image.open(f).convert("RGB") for f in paths])
 
-    return torch.Tensor(mask).permute(2, 0, 1), torch.Tensor(masked_image_clip).permute(2, 0, 1)
 
 class PivotalTuningDatasetCapation(Dataset):
     """
@@ -197,6 +264,8 @@ class PivotalTuningDatasetCapation(Dataset):
         clipseg_prompt="",
         clipseg_mask_ratio=0.0,
         blur_amount: int = 70,
+        cache_images: bool = True,
+        gpu_decode: bool = False,
     ):
         self.size = size
         self.tokenizer = tokenizer
@@ -217,34 +286,42 @@ class PivotalTuningDatasetCapation(Dataset):
             use_mask_captioned_data and use_template
         ), "Can't use both mask caption data and template."
 
+        # List the data root once; every later existence check looks names up here.
+        entries = [
+            entry
+            for entry in os.scandir(instance_data_root)
+            if entry.is_file() and not entry.name.startswith(".")
+        ]
+        names = {entry.name for entry in entries}
+
         # Prepare the instance images
         if use_mask_captioned_data:
-            src_imgs = glob.glob(str(instance_data_root) + "/*src.jpg")
-            for f in src_imgs:
-                idx = int(str(Path(f).stem).split(".")[0])
-                mask_path = f"{instance_data_root}/{idx}.mask.png"
-
-                if Path(mask_path).exists():
-                    self.instance_images_path.append(f)
-                    self.mask_path.append(mask_path)
+            src_imgs = {
+                int(entry.name.split(".")[0]): entry.path
+                for entry in entries
+                if entry.name.endswith("src.jpg")
+            }
+            # caption.txt has one line per image index, in index order
+            all_captions = open(f"{instance_data_root}/caption.txt").readlines()
+
+            self.captions = []
+            for idx in sorted(src_imgs):
+                mask_name = f"{idx}.mask.png"
+
+                if mask_name in names:
+                    self.instance_images_path.append(src_imgs[idx])
+                    self.mask_path.append(f"{instance_data_root}/{mask_name}")
+                    self.captions.append(all_captions[idx])
                 else:
-                    print(f"Mask not found for {f}")
-
-            self.captions = open(f"{instance_data_root}/caption.txt").readlines()
+                    print(f"Mask not found for {src_imgs[idx]}")
 
         else:
-            possibily_src_images = (
-                glob.glob(str(instance_data_root) + "/*.jpg")
-                + glob.glob(str(instance_data_root) + "/*.png")
-                + glob.glob(str(instance_data_root) + "/*.jpeg")
-            )
-            possibily_src_images = (
-                set(possibily_src_images)
-                - set(glob.glob(str(instance_data_root) + "/*mask.png"))
-                - set([str(instance_data_root) + "/caption.txt"])
+            self.instance_images_path = sorted(
+                entry.path
+                for entry in entries
+                if entry.name.lower().endswith((".jpg", ".jpeg", ".png"))
+                and not entry.name.lower().endswith("mask.png")
             )
-
-            self.instance_images_path = list(set(possibily_src_images))
             self.captions = [
                 x.split("/")[-1].split(".")[0] for x in self.instance_images_path
             ]
@@ -253,81 +330,196 @@ class PivotalTuningDatasetCapation(Dataset):
             len(self.instance_images_path) > 0
         ), "No images found in the instance data root."
 
-        self.instance_images_path = sorted(self.instance_images_path)
-
         self.use_mask = use_face_segmentation_condition or use_mask_captioned_data
         self.use_mask_captioned_data = use_mask_captioned_data
 
         if use_face_segmentation_condition:
 
-            for idx in range(len(self.instance_images_path)):
-                targ = f"{instance_data_root}/{idx}.mask.png"
-                # see if the mask exists
-                if not Path(targ).exists():
-                    print(f"Mask not found for {targ}")
-
-                    print(
-                        "Warning : this will pre-process all the images in the instance data root."
-                    )
+            missing = [
+                idx
+                for idx in range(len(self.instance_images_path))
+                if f"{idx}.mask.png" not in names
+            ]
 
-                    if len(self.mask_path) > 0:
-                        print(
-                            "Warning : masks already exists, but will be overwritten."
-                        )
+            if len(missing) > 0:
+                print(
+                    f"Warning : {len(missing)} masks not found, pre-processing them from the instance data root."
+                )
 
-                    masks = face_mask_google_mediapipe(
+                workers = min(os.cpu_count() or 1, len(missing))
+                chunks = [missing[i::workers] for i in range(workers)]
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results = executor.map(
+                        _open_and_mask,
                         [
-                            Image.open(f).convert("RGB")
-                            for f in self.instance_images_path
-                        ]
+                            [self.instance_images_path[idx] for idx in chunk]
+                            for chunk in chunks
+                        ],
                     )
-                    for idx, mask in enumerate(masks):
-                        mask.save(f"{instance_data_root}/{idx}.mask.png")
+                    for chunk, masks in zip(chunks, results):
+                        for idx, mask in zip(chunk, masks):
+                            mask.save(f"{instance_data_root}/{idx}.mask.png")
 
-                    break
-
-            for idx in range(len(self.instance_images_path)):
-                self.mask_path.append(f"{instance_data_root}/{idx}.mask.png")
+            self.mask_path = [
+                f"{instance_data_root}/{idx}.mask.png"
+                for idx in range(len(self.instance_images_path))
+            ]
 
         self.num_instance_images = len(self.instance_images_path)
         self.token_map = token_map
+        if token_map:
+            # longest first, so overlapping tokens resolve to the most specific one
+            self._token_re = re.compile(
+                "|".join(
+                    re.escape(token)
+                    for token in sorted(token_map, key=len, reverse=True)
+                )
+            )
 
         self.use_template = use_template
+        # Prompts only depend on the template or the caption index, so tokenize each one once.
+        self._template_prompt_ids = []
+        self._caption_prompt_ids = {}
         if use_template is not None:
             self.templates = TEMPLATE_MAP[use_template]
 
+            assert self.token_map is not None
+            input_tok = list(self.token_map.values())[0]
+            self._template_prompt_ids = [
+                self._tokenize(template.format(input_tok))
+                for template in self.templates
+            ]
+
         self._length = self.num_instance_images
 
-        self.h_flip = h_flip
-        self.image_transforms = transforms.Compose(
+        # inpainting masks are generated before the flip, so flip them together per batch
+        # with `batch_random_hflip` instead
+        self.h_flip = h_flip and not train_inpainting
+        self.batch_h_flip = h_flip and train_inpainting
+
+        # Resize and crop are deterministic, so their uint8 output is cached once per image;
+        # only the stochastic jitter and the float conversion run per sample.
+        self.image_transforms_geometric = transforms.Compose(
             [
                 transforms.Resize(
-                    size, interpolation=transforms.InterpolationMode.BILINEAR
+                    size,
+                    interpolation=transforms.InterpolationMode.BILINEAR,
+                    antialias=True,
                 )
                 if resize
                 else transforms.Lambda(lambda x: x),
-                transforms.ColorJitter(0.1, 0.1)
-                if color_jitter
-                else transforms.Lambda(lambda x: x),
                 transforms.CenterCrop(size),
-                transforms.ToTensor(),
-                transforms.Normalize([0.5], [0.5]),
             ]
         )
+        self.image_transforms_deterministic = transforms.Compose(
+            [self.image_transforms_geometric, transforms.PILToTensor()]
+        )
+        self.image_transforms_stochastic = (
+            transforms.ColorJitter(0.1, 0.1)
+            if color_jitter
+            else transforms.Lambda(lambda x: x)
+        )
+
+        self.gpu_decode = gpu_decode and torch.cuda.is_available()
+        self.cache_images = cache_images
+        self._image_cache = {}
+        self._mask_cache = {}
+        if cache_images:
+            for idx in range(self.num_instance_images):
+                self._load_instance_image(idx)
+                if self.use_mask:
+                    self._load_mask(idx)
+
+        self._clipseg_masks = {}
+        if train_inpainting and clipseg_mask and clipseg_mask_ratio > 0:
+            self.precompute_clipseg_masks()
 
         self.blur_amount = blur_amount
 
+    def _load_instance_image(self, index):
+        if index in self._image_cache:
+            return self._image_cache[index]
+
+        path = self.instance_images_path[index]
+        if self.gpu_decode and path.lower().endswith((".jpg", ".jpeg")):
+            # nvJPEG decodes straight into a CUDA tensor, only the cropped result comes back.
+            image = decode_jpeg(
+                read_file(path), mode=ImageReadMode.RGB, device="cuda"
+            )
+            image = self.image_transforms_geometric(image).cpu()
+        else:
+            instance_image = Image.open(path)
+            if not instance_image.mode == "RGB":
+                instance_image = instance_image.convert("RGB")
+            image = self.image_transforms_deterministic(instance_image)
+
+        if self.cache_images:
+            self._image_cache[index] = image
+        return image
+
+    def _load_mask(self, index):
+        if index in self._mask_cache:
+            return self._mask_cache[index]
+
+        mask = self.image_transforms_geometric(
+            read_image(self.mask_path[index], mode=ImageReadMode.GRAY)
+        )
+
+        if self.cache_images:
+            self._mask_cache[index] = mask
+        return mask
+
+    def precompute_clipseg_masks(self, batch_size: int = 8):
+        """
+        Runs CLIPSeg over the instance images in batches and caches the resulting masks.
+        """
+        for start in range(0, self.num_instance_images, batch_size):
+            indices = range(start, min(start + batch_size, self.num_instance_images))
+            images = torch.stack(
+                [self._normalize(self._load_instance_image(idx)) for idx in indices]
+            )
+            masks = _generate_clipseg_masks(images, self.clipseg_prompt)
+            for idx, mask in zip(indices, masks):
+                self._clipseg_masks[idx] = mask
+
+        # CLIPSeg is only needed here, so don't keep it on the GPU during training
+        _load_clipseg.cache_clear()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _tokenize(self, text):
+        return self.tokenizer(
+            text,
+            padding="do_not_pad",
+            truncation=True,
+            max_length=self.tokenizer.model_max_length,
+        ).input_ids
+
+    def _get_caption_prompt_ids(self, index):
+        if index not in self._caption_prompt_ids:
+            text = self.captions[index].strip()
+
+            if self.token_map:
+                text = self._token_re.sub(lambda m: self.token_map[m.group(0)], text)
+
+            self._caption_prompt_ids[index] = self._tokenize(text)
+
+        return self._caption_prompt_ids[index]
+
+    @staticmethod
+    def _normalize(image):
+        # uint8 [0, 255] -> float [-1, 1]; the dtype cast is fused into the scale
+        return torch.mul(image, 1 / 127.5).sub_(1.0)
+
     def __len__(self):
         return self._length
 
     def __getitem__(self, index):
         example = {}
-        instance_image = Image.open(
-            self.instance_images_path[index % self.num_instance_images]
+        instance_image = self._load_instance_image(index % self.num_instance_images)
+        example["instance_images"] = self._normalize(
+            self.image_transforms_stochastic(instance_image)
         )
-        if not instance_image.mode == "RGB":
-            instance_image = instance_image.convert("RGB")
-        example["instance_images"] = self.image_transforms(instance_image)
         
         clip_mask_now = random.random() > self.clipseg_mask_ratio
         if (self.train_inpainting and not self.clipseg_mask) or (self.train_inpainting and self.clipseg_mask and clip_mask_now):
@@ -337,46 +529,28 @@ class PivotalTuningDatasetCapation(Dataset):
             ) = _generate_random_mask(example["instance_images"])
         
         elif self.train_inpainting and self.clipseg_mask:
-            (
-                example["instance_masks"],
-                example["instance_masked_images"],
-            ) = _generate_clipseg_mask(example["instance_images"], self.clipseg_prompt)
+            hole = self._clipseg_masks[index % self.num_instance_images]
+            example["instance_masks"] = hole.to(example["instance_images"].dtype)
+            example["instance_masked_images"] = example["instance_images"].masked_fill(
+                hole, 0.0
+            )
 
         if self.use_template:
-            assert self.token_map is not None
-            input_tok = list(self.token_map.values())[0]
-
-            text = random.choice(self.templates).format(input_tok)
+            example["instance_prompt_ids"] = random.choice(self._template_prompt_ids)
         else:
-            text = self.captions[index % self.num_instance_images].strip()
-
-            if self.token_map is not None:
-                for token, value in self.token_map.items():
-                    text = text.replace(token, value)
-
-        print(text)
+            example["instance_prompt_ids"] = self._get_caption_prompt_ids(
+                index % self.num_instance_images
+            )
 
         if self.use_mask:
-            example["mask"] = (
-                self.image_transforms(
-                    Image.open(self.mask_path[index % self.num_instance_images])
-                )
-                * 0.5
-                + 1.0
-            )
+            # uint8 [0, 255] -> float [0.5, 1.5], i.e. Normalize([0.5], [0.5]) * 0.5 + 1.0
+            example["mask"] = torch.mul(
+                self._load_mask(index % self.num_instance_images), 1 / 255
+            ).add_(0.5)
 
         if self.h_flip and random.random() > 0.5:
-            hflip = transforms.RandomHorizontalFlip(p=1)
-
-            example["instance_images"] = hflip(example["instance_images"])
+            example["instance_images"] = TF.hflip(example["instance_images"])
             if self.use_mask:
-                example["mask"] = hflip(example["mask"])
-
-        example["instance_prompt_ids"] = self.tokenizer(
-            text,
-            padding="do_not_pad",
-            truncation=True,
-            max_length=self.tokenizer.model_max_length,
-        ).input_ids
+                example["mask"] = TF.hflip(example["mask"])
 
         return example
\ No newline at end of file
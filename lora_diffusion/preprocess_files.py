@@ -48,11 +48,19 @@ def swin_ir_sr(
         with torch.no_grad():
             outputs = model(**inputs)
 
+        # scale, quantize and go to HWC on the device, then copy the uint8 image back once
         output = (
-            outputs.reconstruction.data.squeeze().float().cpu().clamp_(0, 1).numpy()
+            outputs.reconstruction.data.squeeze()
+            .float()
+            .clamp_(0, 1)
+            .mul_(255.0)
+            .round_()
+            .byte()
+            .permute(1, 2, 0)
+            .contiguous()
+            .cpu()
+            .numpy()
         )
-        output = np.moveaxis(output, source=0, destination=-1)
-        output = (output * 255.0).round().astype(np.uint8)
         output = Image.fromarray(output)
 
         out_images.append(output)